@@ -8,11 +8,12 @@ kernels - Fused normalization with linear layers
 import neuronxcc.nki.language as nl
 import neuronxcc.nki.isa as nisa
 import neuronxcc.nki.compiler as ncc
-import math
 import numpy as np
 from neuronxcc import nki
 from neuronxcc.nki.language import par_dim
 
+from src.kernels import load_k_block
+
 
 def update_base_addr(base_addr, tensor, advance: bool):
     if tensor.ndim == 2:
@@ -21,6 +22,9 @@ def update_base_addr(base_addr, tensor, advance: bool):
     elif tensor.ndim == 3:
         # block_dim, pardim, fdim
         buf_size = tensor.shape[0] * tensor.shape[2] * tensor.itemsize
+    elif tensor.ndim == 4:
+        # block_dim, pardim, fdim, fdim
+        buf_size = tensor.shape[0] * tensor.shape[2] * tensor.shape[3] * tensor.itemsize
     else:
         raise NotImplementedError(
             f"Buffer size for tensor shape {tensor.shape} is unknown"
@@ -67,10 +71,10 @@ def allocated_fused_rms_norm_qkv(
     i_lhs = nl.mgrid[0:pmax, 0:pmax]
     i_rhs = nl.mgrid[0:pmax, 0:fmax]
     i_res = nl.mgrid[0:pmax, 0:fmax]
-    M = math.ceil(dim / pmax)
-    NUM_TRANSP_TILES = math.ceil(dim / fmax)
-    NUM_TILES = math.ceil(seqlen / pmax)
-    TILES_INT = math.ceil(NUM_TILES / hidden_buffer_degree)
+    M = (dim + pmax - 1) // pmax
+    NUM_TRANSP_TILES = (dim + fmax - 1) // fmax
+    NUM_TILES = (seqlen + pmax - 1) // pmax
+    TILES_INT = (NUM_TILES + hidden_buffer_degree - 1) // hidden_buffer_degree
     scale = 1 / dim
     sbuf_base_addr = 0
 
@@ -268,10 +272,17 @@ def allocated_rms_norm(hidden, hidden_buffer_degree, norm_dtype=nl.float32, eps=
         (batch, seqlen, dim), dtype=hidden.dtype, buffer=nl.shared_hbm
     )
 
+    # Rows are normalized independently, so flatten batch and seqlen into a
+    # single row axis. When seqlen < pmax, rows of several batches then share
+    # one tile instead of leaving most of the partitions idle
+    num_rows = batch * seqlen
+    hidden_rows = hidden.reshape((num_rows, dim))
+    out_rows = out_tensor.reshape((num_rows, dim))
+
     pmax = nl.tile_size.pmax  # 128
     ix, iy = nl.mgrid[0:pmax, 0:dim]
-    NUM_TILES = math.ceil(seqlen / pmax)
-    TILES_INT = math.ceil(NUM_TILES / hidden_buffer_degree)
+    NUM_TILES = (num_rows + pmax - 1) // pmax
+    TILES_INT = (NUM_TILES + hidden_buffer_degree - 1) // hidden_buffer_degree
     scale = 1 / dim
     sbuf_base_addr = 0
 
@@ -283,81 +294,266 @@ def allocated_rms_norm(hidden, hidden_buffer_degree, norm_dtype=nl.float32, eps=
     sbuf_base_addr = update_base_addr(sbuf_base_addr, bias_placeholder, True)
     bias_placeholder[...] = 0
 
-    for b in nl.affine_range(batch):
-        for i in nl.affine_range(TILES_INT):
-            # Buffer the input tensor
-            in_bufs = nl.ndarray(
-                (hidden_buffer_degree, par_dim(pmax), dim),
+    for i in nl.affine_range(TILES_INT):
+        # Buffer the input tensor
+        in_bufs = nl.ndarray(
+            (hidden_buffer_degree, par_dim(pmax), dim),
+            dtype=hidden.dtype,
+            buffer=ncc.sbuf.mod_alloc(
+                base_addr=sbuf_base_addr, num_free_tiles=(hidden_buffer_degree,)
+            ),
+        )
+        sbuf_base_addr = update_base_addr(sbuf_base_addr, in_bufs, True)
+        for i_interleave_grp in nl.affine_range(hidden_buffer_degree):
+            in_bufs[i_interleave_grp] = nl.load(
+                hidden_rows[
+                    (hidden_buffer_degree * i + i_interleave_grp) * pmax + ix, iy
+                ],
+                mask=(hidden_buffer_degree * i + i_interleave_grp) * pmax + ix
+                < num_rows,
+            )
+            act = nl.ndarray(
+                (par_dim(pmax), dim),
+                dtype=norm_dtype,
+                buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, act, True)
+
+            # Write the RMS and RMS Reciprocal tensors back out here, in-place
+            square_sum = nl.ndarray(
+                (par_dim(pmax), 1),
+                dtype=norm_dtype,
+                buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, square_sum, True)
+
+            act[...] = nisa.activation_reduce(
+                op=nl.square,
+                data=in_bufs[i_interleave_grp],
+                reduce_op=np.add,
+                reduce_res=square_sum[...],
+                bias=bias_placeholder[...],
+            )
+            square_sum[...] = nisa.tensor_scalar(
+                square_sum[...], np.multiply, scale, op1=np.add, operand1=eps
+            )
+            square_sum[...] = nisa.activation(
+                op=nl.rsqrt, data=square_sum[...], bias=bias_placeholder[...]
+            )
+
+            # Apply normalization
+            output_tile = nl.ndarray(
+                (par_dim(pmax), dim),
                 dtype=hidden.dtype,
-                buffer=ncc.sbuf.mod_alloc(
-                    base_addr=sbuf_base_addr, num_free_tiles=(hidden_buffer_degree,)
-                ),
+                buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
             )
-            sbuf_base_addr = update_base_addr(sbuf_base_addr, in_bufs, True)
-            for i_interleave_grp in nl.affine_range(hidden_buffer_degree):
-                in_bufs[i_interleave_grp] = nl.load(
-                    hidden[
-                        b, (hidden_buffer_degree * i + i_interleave_grp) * pmax + ix, iy
-                    ],
-                    mask=(hidden_buffer_degree * i + i_interleave_grp) * pmax + ix
-                    < seqlen,
-                )
-                act = nl.ndarray(
-                    (par_dim(pmax), dim),
-                    dtype=norm_dtype,
-                    buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
-                )
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, act, True)
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, output_tile, True)
 
-                # Write the RMS and RMS Reciprocal tensors back out here, in-place
-                square_sum = nl.ndarray(
-                    (par_dim(pmax), 1),
-                    dtype=norm_dtype,
-                    buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
-                )
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, square_sum, True)
+            output_tile[...] = nl.multiply(
+                in_bufs[i_interleave_grp],
+                square_sum[...],
+                dtype=hidden.dtype,
+            )
+            # Store result
+            nl.store(
+                out_rows[(hidden_buffer_degree * i + i_interleave_grp) * pmax + ix, iy],
+                value=output_tile,
+                mask=(hidden_buffer_degree * i + i_interleave_grp) * pmax + ix
+                < num_rows,
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, output_tile, False)
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, square_sum, False)
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, act, False)
+        sbuf_base_addr = update_base_addr(sbuf_base_addr, in_bufs, False)
+    sbuf_base_addr = update_base_addr(sbuf_base_addr, bias_placeholder, False)
+    return out_tensor
 
-                act[...] = nisa.activation_reduce(
-                    op=nl.square,
-                    data=in_bufs[i_interleave_grp],
-                    reduce_op=np.add,
-                    reduce_res=square_sum[...],
-                    bias=bias_placeholder[...],
-                )
-                square_sum[...] = nisa.tensor_scalar(
-                    square_sum[...], np.multiply, scale, op1=np.add, operand1=eps
-                )
-                square_sum[...] = nisa.activation(
-                    op=nl.rsqrt, data=square_sum[...], bias=bias_placeholder[...]
-                )
 
-                # Apply normalization
-                output_tile = nl.ndarray(
-                    (par_dim(pmax), dim),
-                    dtype=hidden.dtype,
-                    buffer=ncc.sbuf.mod_alloc(base_addr=sbuf_base_addr),
+def allocated_matmul_stage(
+    result_tiles,
+    lhsT_tiles,
+    rhs_tiles,
+    stage,
+    TILES_IN_BLOCK_M,
+    TILES_IN_BLOCK_N,
+    TILES_IN_BLOCK_K,
+):
+    """
+    Accumulate the K block held in stage `stage` of `lhsT_tiles` and `rhs_tiles` into
+    `result_tiles`. Output tile bm accumulates in PSUM bank bm % 2.
+    """
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+    i_lhsT_mm = nl.mgrid[0:TILE_K, 0:TILE_M]
+    i_rhs_mm = nl.mgrid[0:TILE_K, 0:TILE_N]
+    i_res_mm = nl.mgrid[0:TILE_M, 0:TILE_N]
+
+    for bn in nl.affine_range(TILES_IN_BLOCK_N):
+        res_psum = nl.ndarray(
+            (TILES_IN_BLOCK_M, par_dim(TILE_M), TILE_N),
+            dtype=nl.float32,
+            buffer=ncc.psum.mod_alloc(base_bank=0, num_bank_tiles=(2,)),
+        )
+        for bm in nl.affine_range(TILES_IN_BLOCK_M):
+            for bk in nl.affine_range(TILES_IN_BLOCK_K):
+                res_psum[bm] += nisa.nc_matmul(
+                    lhsT_tiles[stage, i_lhsT_mm.p, bk, bm * TILE_M + i_lhsT_mm.x],
+                    rhs_tiles[stage, i_rhs_mm.p, bk, bn * TILE_N + i_rhs_mm.x],
                 )
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, output_tile, True)
+            result_tiles[bm, i_res_mm.p, bn * TILE_N + i_res_mm.x] += res_psum[
+                bm, i_res_mm.p, i_res_mm.x
+            ]
+
+
+# On-chip placement of allocated_matmul
+#
+# SBUF, per partition (every tile spans all 128 partitions, so buffers are
+# separated by their byte offset on the free axis):
+#   [0, lhsT_end)              lhsT_tiles: NUM_STAGES x TILES_IN_BLOCK_K x BLOCK_M
+#   [lhsT_end, rhs_end)        rhs_tiles: NUM_STAGES x TILES_IN_BLOCK_K x BLOCK_N
+#   [rhs_end, result_end)      result_tiles: TILES_IN_BLOCK_M x BLOCK_N
+# The prefetch DMAs of the next lhsT and rhs K blocks, the tensor engine reads
+# of the current stage and the vector engine writes to result_tiles therefore
+# never touch the same address range. Each stage is laid out like the buffers of
+# nki_matmul_fully_optimized_, so a K block is still loaded with one DMA by
+# load_k_block.
+#
+# PSUM: the output tiles of consecutive bm rotate between banks 0 and 1, so the
+# vector engine drains tile bm into result_tiles while the tensor engine
+# accumulates tile bm + 1 in the other bank.
+@nki.compiler.skip_middle_end_transformations
+@nki.jit
+def allocated_matmul(
+    lhsT,
+    rhs,
+    # Meta-parameters
+    TILES_IN_BLOCK_M=16,
+    TILES_IN_BLOCK_N=2,
+    TILES_IN_BLOCK_K=8,
+):
+    """
+    Allocated version of nki_matmul_fully_optimized_ with explicit SBUF and PSUM placement.
+    This kernel is designed to only handle fp16/bf16 tensor types.
+
+    Args:
+        lhsT (_type_): Input tensor of shape [K,M], where K is a multiple of 128 * TILES_IN_BLOCK_K
+            and M is a multiple of 128 * TILES_IN_BLOCK_M.
+        rhs (_type_): Input tensor of shape [K,N], where K is a multiple of 128 * TILES_IN_BLOCK_K
+            and N is a multiple of 512 * TILES_IN_BLOCK_N.
+        TILES_IN_BLOCK_* (int, optional): Meta parameters to control blocking dimensions.
+    """
+    K, M = lhsT.shape
+    K_, N = rhs.shape
+    assert K == K_, "lhsT and rhs must have the same contraction dimension"
+
+    result = nl.ndarray((M, N), dtype=lhsT.dtype, buffer=nl.shared_hbm)
+
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+
+    BLOCK_M = TILE_M * TILES_IN_BLOCK_M
+    BLOCK_N = TILE_N * TILES_IN_BLOCK_N
+    BLOCK_K = TILE_K * TILES_IN_BLOCK_K
+
+    # the size has to be multiple of block size
+    assert M % BLOCK_M == 0
+    assert N % BLOCK_N == 0
+    assert K % BLOCK_K == 0
 
-                output_tile[...] = nl.multiply(
-                    in_bufs[i_interleave_grp],
-                    square_sum[...],
-                    dtype=hidden.dtype,
+    NUM_BLOCK_M = M // BLOCK_M
+    NUM_BLOCK_N = N // BLOCK_N
+    NUM_BLOCK_K = K // BLOCK_K
+    NUM_STAGES = 2
+
+    i_res_packed = nl.mgrid[0:TILE_M, 0:BLOCK_N]
+    sbuf_base_addr = 0
+
+    for n in nl.affine_range(NUM_BLOCK_N):
+        for m in nl.affine_range(NUM_BLOCK_M):
+            lhsT_tiles = nl.ndarray(
+                (NUM_STAGES, par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_M),
+                dtype=lhsT.dtype,
+                buffer=ncc.sbuf.mod_alloc(
+                    base_addr=sbuf_base_addr, num_free_tiles=(NUM_STAGES,)
+                ),
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, lhsT_tiles, True)
+            rhs_tiles = nl.ndarray(
+                (NUM_STAGES, par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_N),
+                dtype=rhs.dtype,
+                buffer=ncc.sbuf.mod_alloc(
+                    base_addr=sbuf_base_addr, num_free_tiles=(NUM_STAGES,)
+                ),
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, rhs_tiles, True)
+            result_tiles = nl.zeros(
+                (TILES_IN_BLOCK_M, par_dim(TILE_M), BLOCK_N),
+                dtype=lhsT.dtype,
+                buffer=ncc.sbuf.mod_alloc(
+                    base_addr=sbuf_base_addr, num_free_tiles=(TILES_IN_BLOCK_M,)
+                ),
+            )
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, result_tiles, True)
+
+            load_k_block(lhsT_tiles, lhsT, 0, 0, m, TILES_IN_BLOCK_K)
+            load_k_block(rhs_tiles, rhs, 0, 0, n, TILES_IN_BLOCK_K)
+            # Double buffered K loop, the stages are unrolled at trace time
+            # With a single K block only the tail below runs
+            if NUM_BLOCK_K >= NUM_STAGES:
+                for k in nl.sequential_range(NUM_BLOCK_K // NUM_STAGES):
+                    for stage in range(NUM_STAGES):
+                        next_stage = (stage + 1) % NUM_STAGES
+                        next_k = NUM_STAGES * k + stage + 1
+                        load_k_block(
+                            lhsT_tiles,
+                            lhsT,
+                            next_stage,
+                            next_k,
+                            m,
+                            TILES_IN_BLOCK_K,
+                            prefetch=True,
+                        )
+                        load_k_block(
+                            rhs_tiles,
+                            rhs,
+                            next_stage,
+                            next_k,
+                            n,
+                            TILES_IN_BLOCK_K,
+                            prefetch=True,
+                        )
+                        allocated_matmul_stage(
+                            result_tiles,
+                            lhsT_tiles,
+                            rhs_tiles,
+                            stage,
+                            TILES_IN_BLOCK_M,
+                            TILES_IN_BLOCK_N,
+                            TILES_IN_BLOCK_K,
+                        )
+            if NUM_BLOCK_K % NUM_STAGES != 0:
+                allocated_matmul_stage(
+                    result_tiles,
+                    lhsT_tiles,
+                    rhs_tiles,
+                    (NUM_BLOCK_K - 1) % NUM_STAGES,
+                    TILES_IN_BLOCK_M,
+                    TILES_IN_BLOCK_N,
+                    TILES_IN_BLOCK_K,
                 )
-                # Store result
+
+            # Store result
+            for bm in nl.affine_range(TILES_IN_BLOCK_M):
                 nl.store(
-                    out_tensor[
-                        b,
-                        (hidden_buffer_degree * i + i_interleave_grp) * pmax + ix,
-                        iy,
+                    result[
+                        (TILES_IN_BLOCK_M * m + bm) * TILE_M + i_res_packed.p,
+                        BLOCK_N * n + i_res_packed.x,
                     ],
-                    value=output_tile,
-                    mask=(hidden_buffer_degree * i + i_interleave_grp) * pmax + ix
-                    < seqlen,
+                    value=result_tiles[bm, i_res_packed.p, i_res_packed.x],
                 )
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, output_tile, False)
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, square_sum, False)
-                sbuf_base_addr = update_base_addr(sbuf_base_addr, act, False)
-            sbuf_base_addr = update_base_addr(sbuf_base_addr, in_bufs, False)
-    sbuf_base_addr = update_base_addr(sbuf_base_addr, bias_placeholder, False)
-    return out_tensor
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, result_tiles, False)
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, rhs_tiles, False)
+            sbuf_base_addr = update_base_addr(sbuf_base_addr, lhsT_tiles, False)
+    return result
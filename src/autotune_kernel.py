@@ -39,6 +39,7 @@ class Autotune:
             benchmark_machines if benchmark_machines is not None else ["localhost"]
         )
         self.perf_results = []
+        self.best_config = None
 
         if "cache_dir" in self.kwargs:
             cache_dir = self.kwargs["cache_dir"]
@@ -113,6 +114,7 @@ class Autotune:
         )
         min_latency = best_result["latency"]
         min_config = best_result["configs"]
+        self.best_config = min_config
 
         # Dump the performance logs
         with open(f"{self.cache_dir}/tune.log", "w") as f:
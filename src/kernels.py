@@ -5,7 +5,6 @@ import neuronxcc.nki.language as nl
 import neuronxcc.nki.isa as nisa
 
 import logging
-import math
 from functools import partial
 from typing import Optional
 import neuronxcc.nki as nki
@@ -15,6 +14,275 @@ import neuronxcc.nki.compiler as ncc
 from neuronxcc.nki.language import par_dim
 import numpy as np
 
+# SBUF is 24 MiB, split across 128 partitions
+SBUF_BYTES_PER_PARTITION = 24 * 1024 * 1024 // 128
+# Number of SBUF buffers the K blocks of matmul_blocked rotate through
+MATMUL_NUM_STAGES = 2
+# Only the PSUM accumulator needs fp32, matmul_blocked keeps the SBUF copy in bf16
+MATMUL_RESULT_DTYPE = nl.bfloat16
+
+
+def load_k_block(tiles, src, stage, k, j, TILES_IN_BLOCK_K, prefetch=False):
+    """Load K block `k` of free block `j` from `src` into SBUF buffer `tiles[stage]`.
+
+    Args:
+        tiles: SBUF buffer of shape [NUM_STAGES, TILE_K, TILES_IN_BLOCK_K, BLOCK].
+        src: an HBM tensor of shape [K, F] (lhsT or rhs).
+        prefetch: mask out rows past the end of K, so the load for the block after
+          the current one can be issued unconditionally in a pipelined loop.
+    """
+    TILE_K = nl.tile_size.pmax  # 128
+    BLOCK = tiles.shape[-1]
+    K = src.shape[0]
+
+    # Load the whole `BLOCK_K x BLOCK` region with a single DMA: partition p holds
+    # row p of every K tile in the block, strided along the free axis
+    i_p = nl.arange(TILE_K)[:, None, None]
+    i_bk = nl.arange(TILES_IN_BLOCK_K)[None, :, None]
+    i_f = nl.arange(BLOCK)[None, None, :]
+    row = (TILES_IN_BLOCK_K * k + i_bk) * TILE_K + i_p
+    tiles[stage, i_p, i_bk, i_f] = nl.load(
+        src[row, BLOCK * j + i_f],
+        mask=(row < K) if prefetch else None,
+    )
+
+
+def load_k_block_transposed(tiles, src, stage, k, j, TILES_IN_BLOCK_K, prefetch=False):
+    """Same as load_k_block, but for a `src` of shape [F, K].
+
+    Each K tile is transposed by the DMA while loading, so `tiles` ends up in the
+    same [NUM_STAGES, TILE_K, TILES_IN_BLOCK_K, BLOCK] layout as load_k_block.
+    """
+    TILE_K = nl.tile_size.pmax  # 128
+    BLOCK = tiles.shape[-1]
+    K = src.shape[1]
+
+    i_src = nl.mgrid[0:BLOCK, 0:TILE_K]
+    i_tile = nl.mgrid[0:TILE_K, 0:BLOCK]
+    for bk in nl.affine_range(TILES_IN_BLOCK_K):
+        col = (TILES_IN_BLOCK_K * k + bk) * TILE_K + i_src.x
+        tiles[stage, i_tile.p, bk, i_tile.x] = nl.load_transpose2d(
+            src[BLOCK * j + i_src.p, col],
+            mask=(col < K) if prefetch else None,
+        )
+
+
+def matmul_k_block(
+    result_tiles,
+    lhsT_tiles,
+    rhs_tiles,
+    stage,
+    TILES_IN_BLOCK_M,
+    TILES_IN_BLOCK_N,
+    TILES_IN_BLOCK_K,
+):
+    """Accumulate the contribution of one K block into `result_tiles`.
+
+    `lhsT_tiles[stage]` and `rhs_tiles[stage]` must already hold the lhsT and rhs
+    tiles of that K block.
+    """
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+
+    # Do matmul with all tiles in the blocks
+    i_lhsT_mm = nl.mgrid[0:TILE_K, 0:TILE_M]
+    i_rhs_mm = nl.mgrid[0:TILE_K, 0:TILE_N]
+    i_res_mm = nl.mgrid[0:TILE_M, 0:TILE_N]
+
+    # M tiles are processed in pairs that share one PSUM buffer with a slot per
+    # tile, so the second tile accumulates in its own slot while the first one is
+    # drained into SBUF. An odd TILES_IN_BLOCK_M falls back to one tile at a time
+    NUM_PSUM_SLOTS = 2 if TILES_IN_BLOCK_M % 2 == 0 else 1
+    for bn in nl.affine_range(TILES_IN_BLOCK_N):
+        for bp in nl.affine_range(TILES_IN_BLOCK_M // NUM_PSUM_SLOTS):
+            res_tiles = nl.zeros(
+                (NUM_PSUM_SLOTS, nl.par_dim(TILE_M), TILE_N),
+                dtype=nl.float32,
+                buffer=nl.psum,
+            )
+            for slot in range(NUM_PSUM_SLOTS):
+                bm = NUM_PSUM_SLOTS * bp + slot
+                for bk in nl.affine_range(TILES_IN_BLOCK_K):
+                    res_tiles[slot, i_res_mm.p, i_res_mm.x] += nisa.nc_matmul(
+                        lhsT_tiles[stage, i_lhsT_mm.p, bk, bm * TILE_M + i_lhsT_mm.x],
+                        rhs_tiles[stage, i_rhs_mm.p, bk, bn * TILE_N + i_rhs_mm.x],
+                    )
+
+                # Accumulate on corresponding SBUF tile, the result is written in
+                # the dtype of result_tiles
+                result_tiles[bm, i_res_mm.p, bn * TILE_N + i_res_mm.x] += res_tiles[
+                    slot, i_res_mm.p, i_res_mm.x
+                ]
+
+
+def fits_on_chip(config, dtype_bytes):
+    """Capacity model of matmul_blocked for one SBUF partition.
+
+    SBUF holds the result block plus MATMUL_NUM_STAGES K blocks of lhsT and rhs.
+    PSUM is not modelled: it holds two fp32 result tiles in flight whatever the
+    config.
+    """
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+
+    BLOCK_M = TILE_M * config["TILES_IN_BLOCK_M"]
+    BLOCK_N = TILE_N * config["TILES_IN_BLOCK_N"]
+    result_bytes = (
+        config["TILES_IN_BLOCK_M"] * BLOCK_N * np.dtype(MATMUL_RESULT_DTYPE).itemsize
+    )
+    input_bytes = (
+        MATMUL_NUM_STAGES
+        * config["TILES_IN_BLOCK_K"]
+        * (BLOCK_M + BLOCK_N)
+        * dtype_bytes
+    )
+    return result_bytes + input_bytes <= SBUF_BYTES_PER_PARTITION
+
+
+def matmul_blocked(
+    lhs, rhs, TILES_IN_BLOCK_M, TILES_IN_BLOCK_N, TILES_IN_BLOCK_K, transpose_lhs
+):
+    """Blocked matmul body shared by the nki_matmul_fully_optimized_* kernels.
+
+    `lhs` is [K,M] (pre-transposed) unless `transpose_lhs` is set, in which case
+    it is [M,K] and every lhs K block is transposed while loading into SBUF.
+    """
+    if transpose_lhs:
+        M, K = lhs.shape
+        load_lhs_k_block = load_k_block_transposed
+    else:
+        K, M = lhs.shape
+        load_lhs_k_block = load_k_block
+    K_, N = rhs.shape
+    assert K == K_, "lhs and rhs must have the same contraction dimension"
+
+    result = nl.ndarray((M, N), dtype=lhs.dtype, buffer=nl.shared_hbm)
+
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+
+    BLOCK_M = TILE_M * TILES_IN_BLOCK_M
+    BLOCK_N = TILE_N * TILES_IN_BLOCK_N
+    BLOCK_K = TILE_K * TILES_IN_BLOCK_K
+
+    # the size has to be multiple of block size
+    assert M % BLOCK_M == 0
+    assert N % BLOCK_N == 0
+    assert K % BLOCK_K == 0
+
+    NUM_BLOCK_M = M // BLOCK_M
+    NUM_BLOCK_N = N // BLOCK_N
+    NUM_BLOCK_K = K // BLOCK_K
+
+    NUM_STAGES = MATMUL_NUM_STAGES
+
+    # Loop-invariant indices of the result store
+    i_res_packed = nl.mgrid[0:TILE_K, 0:BLOCK_N]
+
+    # Blocking N dimension (the RHS free dimension)
+    for n in nl.affine_range(NUM_BLOCK_N):
+        # Blocking M dimension (the LHS free dimension)
+        # Keeping M outside of K means only one M block of results lives in SBUF
+        for m in nl.affine_range(NUM_BLOCK_M):
+            # The N tiles of a row are laid out contiguously, so every row of
+            # result tiles is already packed for a single coalesced store
+            result_tiles = nl.zeros(
+                (TILES_IN_BLOCK_M, nl.par_dim(TILE_M), BLOCK_N),
+                dtype=MATMUL_RESULT_DTYPE,
+                buffer=nl.sbuf,
+            )
+
+            # Double buffer the input tiles: while the tensor engine consumes one
+            # stage, the DMA engines prefetch the next K block into the other stage
+            lhsT_tiles = nl.ndarray(
+                (NUM_STAGES, nl.par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_M),
+                dtype=lhs.dtype,
+                buffer=nl.sbuf,
+            )
+            rhs_tiles = nl.ndarray(
+                (NUM_STAGES, nl.par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_N),
+                dtype=rhs.dtype,
+                buffer=nl.sbuf,
+            )
+            load_lhs_k_block(lhsT_tiles, lhs, 0, 0, m, TILES_IN_BLOCK_K)
+            load_k_block(rhs_tiles, rhs, 0, 0, n, TILES_IN_BLOCK_K)
+
+            # Blocking K dimension (the contraction dimension)
+            # Use `sequential_range` because the stages carry a dependency from one
+            # iteration to the next. The stages are unrolled at trace time so that
+            # every buffer index stays static.
+            # An `affine_range` K loop would need a separate partial result block
+            # per K block, i.e. NUM_BLOCK_K copies of result_tiles in SBUF, which
+            # does not fit for large K. The explicit prefetch gives the DMA and
+            # tensor engine overlap instead.
+            # With a single K block only the tail below runs
+            if NUM_BLOCK_K >= NUM_STAGES:
+                for k in nl.sequential_range(NUM_BLOCK_K // NUM_STAGES):
+                    for stage in range(NUM_STAGES):
+                        next_stage = (stage + 1) % NUM_STAGES
+                        next_k = NUM_STAGES * k + stage + 1
+                        load_lhs_k_block(
+                            lhsT_tiles,
+                            lhs,
+                            next_stage,
+                            next_k,
+                            m,
+                            TILES_IN_BLOCK_K,
+                            prefetch=True,
+                        )
+                        load_k_block(
+                            rhs_tiles,
+                            rhs,
+                            next_stage,
+                            next_k,
+                            n,
+                            TILES_IN_BLOCK_K,
+                            prefetch=True,
+                        )
+                        matmul_k_block(
+                            result_tiles,
+                            lhsT_tiles,
+                            rhs_tiles,
+                            stage,
+                            TILES_IN_BLOCK_M,
+                            TILES_IN_BLOCK_N,
+                            TILES_IN_BLOCK_K,
+                        )
+
+            # The last K block was already loaded, by the prefetch of the final
+            # iteration above or, for a single K block, before the loop
+            if NUM_BLOCK_K % NUM_STAGES != 0:
+                matmul_k_block(
+                    result_tiles,
+                    lhsT_tiles,
+                    rhs_tiles,
+                    (NUM_BLOCK_K - 1) % NUM_STAGES,
+                    TILES_IN_BLOCK_M,
+                    TILES_IN_BLOCK_N,
+                    TILES_IN_BLOCK_K,
+                )
+
+            # Copying the result from SBUF to HBM
+            for bm in nl.affine_range(TILES_IN_BLOCK_M):
+                if result_tiles.dtype == result.dtype:
+                    result_packed = result_tiles[bm, i_res_packed.p, i_res_packed.x]
+                else:
+                    # cast back to the output dtype before the store
+                    result_packed = nl.copy(
+                        result_tiles[bm, i_res_packed.p, i_res_packed.x],
+                        dtype=result.dtype,
+                    )
+                nl.store(
+                    result[
+                        (TILES_IN_BLOCK_M * m + bm) * TILE_K + i_res_packed.p,
+                        BLOCK_N * n + i_res_packed.x,
+                    ],
+                    value=result_packed,
+                )
+    return result
+
 
 # This is taken from the open source NKI samples repo
 # https://github.com/aws-neuron/nki-samples/blob/main/src/tutorials/matrix_multiplication/matrix_multiplication_nki_kernels.py#L247
@@ -38,10 +306,78 @@ def nki_matmul_fully_optimized_(
         rhs: an input tensor of shape [K,N],  where K is a multiple of 128 *
           TILES_IN_BLOCK_K and N is a multiple of 512 * TILES_IN_BLOCK_N.  It is
           the right-hand-side argument of the matrix multiplication.
+        result: the resulting output tensor of shape [M,N]. Partial sums across
+          K blocks are kept in bf16 in SBUF, only the PSUM accumulator is fp32.
+        TILES_IN_BLOCK_*: meta parameters to control blocking dimensions
+    """
+    return matmul_blocked(
+        lhsT,
+        rhs,
+        TILES_IN_BLOCK_M,
+        TILES_IN_BLOCK_N,
+        TILES_IN_BLOCK_K,
+        transpose_lhs=False,
+    )
+
+
+@nki.jit
+def nki_matmul_fully_optimized_nontransposed(
+    lhs,
+    rhs,
+    # Meta-parameters
+    TILES_IN_BLOCK_M=16,
+    TILES_IN_BLOCK_N=2,
+    TILES_IN_BLOCK_K=8,
+):
+    """Same as nki_matmul_fully_optimized_, but takes lhs in its natural layout.
+
+    Args:
+        lhs: an input tensor of shape [M,K], where K is a multiple of 128 *
+          TILES_IN_BLOCK_K and M is a multiple of 128 * TILES_IN_BLOCK_M.  It is
+          transposed on the fly by the DMA into the SBUF layout expected by the
+          tensor engine, so callers do not need a separate transpose pass on the
+          host.
+        rhs: an input tensor of shape [K,N],  where K is a multiple of 128 *
+          TILES_IN_BLOCK_K and N is a multiple of 512 * TILES_IN_BLOCK_N.
         result: the resulting output tensor of shape [M,N]
         TILES_IN_BLOCK_*: meta parameters to control blocking dimensions
     """
+    return matmul_blocked(
+        lhs,
+        rhs,
+        TILES_IN_BLOCK_M,
+        TILES_IN_BLOCK_N,
+        TILES_IN_BLOCK_K,
+        transpose_lhs=True,
+    )
+
+
+@nki.jit
+def nki_matmul_splitk_(
+    lhsT,
+    rhs,
+    # Meta-parameters
+    SPLIT_K=4,
+    TILES_IN_BLOCK_M=1,
+    TILES_IN_BLOCK_N=2,
+    TILES_IN_BLOCK_K=8,
+):
+    """Split-K matrix multiplication for tall-skinny shapes (small M*N, large K).
 
+    When there are only a few (M, N) blocks, the K loop of nki_matmul_fully_optimized_
+    is one long dependency chain. Here K is partitioned into SPLIT_K independent
+    ranges, each accumulating into its own SBUF partial result, and the partial
+    results are added together in SBUF before the store.
+
+    Args:
+        lhsT: an input tensor of shape [K,M], where K is a multiple of 128 *
+          TILES_IN_BLOCK_K * SPLIT_K and M is a multiple of 128 * TILES_IN_BLOCK_M.
+        rhs: an input tensor of shape [K,N],  where K is a multiple of 128 *
+          TILES_IN_BLOCK_K * SPLIT_K and N is a multiple of 512 * TILES_IN_BLOCK_N.
+        result: the resulting output tensor of shape [M,N]
+        SPLIT_K: number of independent accumulators the K dimension is split into
+        TILES_IN_BLOCK_*: meta parameters to control blocking dimensions
+    """
     K, M = lhsT.shape
     K_, N = rhs.shape
     assert K == K_, "lhsT and rhs must have the same contraction dimension"
@@ -59,109 +395,194 @@ def nki_matmul_fully_optimized_(
     # the size has to be multiple of block size
     assert M % BLOCK_M == 0
     assert N % BLOCK_N == 0
-    assert K % BLOCK_K == 0
+    assert K % (BLOCK_K * SPLIT_K) == 0
 
     NUM_BLOCK_M = M // BLOCK_M
     NUM_BLOCK_N = N // BLOCK_N
-    NUM_BLOCK_K = K // BLOCK_K
+    # Number of K blocks accumulated by each split
+    NUM_BLOCK_K_PER_SPLIT = K // (BLOCK_K * SPLIT_K)
 
-    # Blocking N dimension (the RHS free dimension)
-    for n in nl.affine_range(NUM_BLOCK_N):
-        result_tiles = nl.zeros(
-            (
-                NUM_BLOCK_M,
-                TILES_IN_BLOCK_M,
-                TILES_IN_BLOCK_N,
-                nl.par_dim(TILE_M),
-                TILE_N,
-            ),
-            dtype=lhsT.dtype,
-            buffer=nl.sbuf,
-        )
+    i_res_packed = nl.mgrid[0:TILE_M, 0:BLOCK_N]
 
-        # Blocking K dimension (the contraction dimension)
-        # Use `sequential_range` because we do not want the compiler to change this loop by,
-        # for example, vectorizing it
-        for k in nl.sequential_range(NUM_BLOCK_K):
-            # Loading tiles from rhs
-            # setting the load tile to `TILE_K x BLOCK_SIZE_N` to optimize DMA performance
-            i_rhs = nl.mgrid[0:TILE_K, 0:BLOCK_N]
-            rhs_tiles = nl.ndarray(
-                (TILES_IN_BLOCK_K, nl.par_dim(TILE_K), BLOCK_N),
-                dtype=rhs.dtype,
+    for n in nl.affine_range(NUM_BLOCK_N):
+        for m in nl.affine_range(NUM_BLOCK_M):
+            # M*N is small, so the partial sums can stay in fp32
+            result_tiles = nl.zeros(
+                (TILES_IN_BLOCK_M, nl.par_dim(TILE_M), BLOCK_N),
+                dtype=nl.float32,
                 buffer=nl.sbuf,
             )
 
-            for bk_r in nl.affine_range(TILES_IN_BLOCK_K):
-                rhs_tiles[bk_r, i_rhs.p, i_rhs.x] = nl.load(
-                    rhs[
-                        (TILES_IN_BLOCK_K * k + bk_r) * TILE_K + i_rhs.p,
-                        BLOCK_N * n + i_rhs.x,
-                    ]
-                )
-
-            # Blocking M dimension (the LHS free dimension)
-            for m in nl.affine_range(NUM_BLOCK_M):
-                # Loading tiles from lhsT
-                i_lhsT = nl.mgrid[0:TILE_K, 0:BLOCK_M]
-                lhsT_tiles = nl.ndarray(
-                    (TILES_IN_BLOCK_K, nl.par_dim(TILE_K), BLOCK_M),
-                    dtype=lhsT.dtype,
+            # The splits do not depend on each other
+            for s in nl.affine_range(SPLIT_K):
+                partial_tiles = nl.zeros(
+                    (TILES_IN_BLOCK_M, nl.par_dim(TILE_M), BLOCK_N),
+                    dtype=nl.float32,
                     buffer=nl.sbuf,
                 )
-                for bk_l in nl.affine_range(TILES_IN_BLOCK_K):
-                    lhsT_tiles[bk_l, i_lhsT.p, i_lhsT.x] = nl.load(
-                        lhsT[
-                            (TILES_IN_BLOCK_K * k + bk_l) * TILE_K + i_lhsT.p,
-                            BLOCK_M * m + i_lhsT.x,
-                        ]
+                for k in nl.sequential_range(NUM_BLOCK_K_PER_SPLIT):
+                    lhsT_tiles = nl.ndarray(
+                        (1, nl.par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_M),
+                        dtype=lhsT.dtype,
+                        buffer=nl.sbuf,
+                    )
+                    rhs_tiles = nl.ndarray(
+                        (1, nl.par_dim(TILE_K), TILES_IN_BLOCK_K, BLOCK_N),
+                        dtype=rhs.dtype,
+                        buffer=nl.sbuf,
+                    )
+                    load_k_block(
+                        lhsT_tiles,
+                        lhsT,
+                        0,
+                        NUM_BLOCK_K_PER_SPLIT * s + k,
+                        m,
+                        TILES_IN_BLOCK_K,
+                    )
+                    load_k_block(
+                        rhs_tiles,
+                        rhs,
+                        0,
+                        NUM_BLOCK_K_PER_SPLIT * s + k,
+                        n,
+                        TILES_IN_BLOCK_K,
+                    )
+                    matmul_k_block(
+                        partial_tiles,
+                        lhsT_tiles,
+                        rhs_tiles,
+                        0,
+                        TILES_IN_BLOCK_M,
+                        TILES_IN_BLOCK_N,
+                        TILES_IN_BLOCK_K,
                     )
 
-                # Do matmul with all tiles in the blocks
-                i_lhsT_mm = nl.mgrid[0:TILE_K, 0:TILE_M]
-                i_rhs_mm = nl.mgrid[0:TILE_K, 0:TILE_N]
-                i_res_mm = nl.mgrid[0:TILE_M, 0:TILE_N]
-                for bn in nl.affine_range(TILES_IN_BLOCK_N):
-                    for bm in nl.affine_range(TILES_IN_BLOCK_M):
-                        res_tile = nl.zeros(
-                            (TILE_M, TILE_N), dtype=nl.float32, buffer=nl.psum
-                        )
-
-                        for bk in nl.affine_range(TILES_IN_BLOCK_K):
-                            res_tile[...] += nisa.nc_matmul(
-                                lhsT_tiles[bk, i_lhsT_mm.p, bm * TILE_M + i_lhsT_mm.x],
-                                rhs_tiles[bk, i_rhs_mm.p, bn * TILE_N + i_rhs_mm.x],
-                            )
-
-                        # Accumulate on corresponding SBUF tile
-                        result_tiles[m, bm, bn, i_res_mm.p, i_res_mm.x] += res_tile[
-                            i_res_mm.p, i_res_mm.x
-                        ]
+                # Reduce the split into the result, `+=` keeps this an associative
+                # reduction so the split loop can stay an `affine_range`
+                for bm in nl.affine_range(TILES_IN_BLOCK_M):
+                    result_tiles[bm, i_res_packed.p, i_res_packed.x] += partial_tiles[
+                        bm, i_res_packed.p, i_res_packed.x
+                    ]
 
-        # Copying the result from SBUF to HBM
-        for m in nl.affine_range(NUM_BLOCK_M):
+            # Copying the result from SBUF to HBM
             for bm in nl.affine_range(TILES_IN_BLOCK_M):
-                i_res = nl.mgrid[0:TILE_K, 0:TILE_N]
-                i_res_packed = nl.mgrid[0:TILE_K, 0:BLOCK_N]
-                result_packed = nl.ndarray(
-                    (TILE_K, BLOCK_N), dtype=result_tiles.dtype, buffer=nl.sbuf
-                )
-
-                # coalesce result tiles for better DMA performance
-                for bn in nl.affine_range(TILES_IN_BLOCK_N):
-                    result_packed[i_res.p, bn * TILE_N + i_res.x] = nl.copy(
-                        result_tiles[m, bm, bn, i_res.p, i_res.x]
-                    )
                 nl.store(
                     result[
-                        (TILES_IN_BLOCK_M * m + bm) * TILE_K + i_res_packed.p,
+                        (TILES_IN_BLOCK_M * m + bm) * TILE_M + i_res_packed.p,
                         BLOCK_N * n + i_res_packed.x,
                     ],
-                    value=result_packed[i_res_packed.p, i_res_packed.x],
+                    value=nl.copy(
+                        result_tiles[bm, i_res_packed.p, i_res_packed.x],
+                        dtype=result.dtype,
+                    ),
                 )
     return result
 
 
+def tiles_in_block(size, tile_size, max_tiles, name):
+    """Largest number of tiles, at most `max_tiles`, that evenly blocks `size`."""
+    if size % tile_size != 0:
+        raise ValueError(f"{name}={size} must be a multiple of {tile_size}")
+    num_tiles = size // tile_size
+    return max(t for t in range(1, max_tiles + 1) if num_tiles % t == 0)
+
+
+def nki_matmul(lhsT, rhs):
+    """Dispatch to the matmul kernel that suits the shape of lhsT [K,M] and rhs [K,N].
+
+    Tall-skinny problems (M < 512 and K > 8192) go to nki_matmul_splitk_ when K
+    splits evenly, everything else goes to nki_matmul_fully_optimized_. The blocking
+    is chosen from the shape, never exceeding the default TILES_IN_BLOCK_* of
+    nki_matmul_fully_optimized_. For the fully optimized kernel, TILES_IN_BLOCK_K
+    and then TILES_IN_BLOCK_M are shrunk until fits_on_chip accepts the blocking
+    for the dtype of lhsT.
+
+    Raises:
+        ValueError: if M is not a multiple of 128, N of 512 or K of 128, or if no
+          blocking fits in SBUF.
+    """
+    K, M = lhsT.shape
+    K_, N = rhs.shape
+    if K != K_:
+        raise ValueError(f"lhsT has K={K} but rhs has K={K_}")
+
+    TILE_M = nl.tile_size.gemm_stationary_fmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+    SPLIT_K = 4
+
+    TILES_IN_BLOCK_M = tiles_in_block(M, TILE_M, 16, "M")
+    TILES_IN_BLOCK_N = tiles_in_block(N, TILE_N, 2, "N")
+    TILES_IN_BLOCK_K = tiles_in_block(K, TILE_K, 8, "K")
+    if M < 512 and K > 8192 and K % (TILE_K * SPLIT_K) == 0:
+        return nki_matmul_splitk_(
+            lhsT,
+            rhs,
+            SPLIT_K=SPLIT_K,
+            TILES_IN_BLOCK_M=TILES_IN_BLOCK_M,
+            TILES_IN_BLOCK_N=TILES_IN_BLOCK_N,
+            TILES_IN_BLOCK_K=tiles_in_block(K // SPLIT_K, TILE_K, 8, "K"),
+        )
+
+    config = {
+        "TILES_IN_BLOCK_M": TILES_IN_BLOCK_M,
+        "TILES_IN_BLOCK_N": TILES_IN_BLOCK_N,
+        "TILES_IN_BLOCK_K": TILES_IN_BLOCK_K,
+    }
+    dtype_bytes = np.dtype(lhsT.dtype).itemsize
+    while not fits_on_chip(config, dtype_bytes):
+        # Shrinking K first keeps the result block, and so the reuse of every
+        # loaded tile, as large as possible
+        if config["TILES_IN_BLOCK_K"] > 1:
+            config["TILES_IN_BLOCK_K"] = tiles_in_block(
+                K, TILE_K, config["TILES_IN_BLOCK_K"] - 1, "K"
+            )
+        elif config["TILES_IN_BLOCK_M"] > 1:
+            config["TILES_IN_BLOCK_M"] = tiles_in_block(
+                M, TILE_M, config["TILES_IN_BLOCK_M"] - 1, "M"
+            )
+        else:
+            raise ValueError(f"No blocking of {(M, N, K)} fits in SBUF")
+    return nki_matmul_fully_optimized_(lhsT, rhs, **config)
+
+
+def rmsnorm_rows_tile(hidden_rows, i, inv_dim, num_rows=None):
+    """Load and normalize rows [i * pmax, (i + 1) * pmax) of `hidden_rows`.
+
+    The normalized tile is returned in SBUF. Pass `num_rows` to mask out the rows
+    past the end of a partial last tile.
+    """
+    pmax = nl.tile_size.pmax  # 128
+    dim = hidden_rows.shape[1]
+    ix = nl.arange(pmax)[:, None]
+    iy = nl.arange(dim)[None, :]
+
+    # Load input data from external memory to on-chip memory
+    a_tile = nl.load(
+        hidden_rows[i * pmax + ix, iy],
+        mask=(i * pmax + ix < num_rows) if num_rows is not None else None,
+    )
+
+    # Square hidden and sum along the last dimension in a single
+    # scalar-engine instruction, the reduction is accumulated
+    # into square_sum as the squared values are produced
+    square_sum = nl.ndarray((par_dim(pmax), 1), dtype=nl.float32, buffer=nl.sbuf)
+    nisa.activation_reduce(
+        op=nl.square, data=a_tile, reduce_op=np.add, reduce_res=square_sum
+    )
+
+    # Scale by 1/dim to get the mean, then take the reciprocal square root.
+    # The scale is applied by the activation itself, so both run as a single
+    # scalar-engine instruction per row
+    rms_reciprocal = nisa.activation(op=nl.rsqrt, data=square_sum, scale=inv_dim)
+
+    # Scale the input tensor in place, reusing the a_tile allocation.
+    # The per-row scale is folded into the activation instruction that
+    # produces the store source, instead of a separate multiply
+    a_tile[...] = nisa.activation(op=nl.copy, data=a_tile, scale=rms_reciprocal)
+    return a_tile
+
+
 @nki.jit
 def nki_rmsnorm_kernel(hidden):
     pmax, fmax = nl.tile_size.pmax, nl.tile_size.psum_fmax  # 128, 512
@@ -170,6 +591,8 @@ def nki_rmsnorm_kernel(hidden):
     batch = hidden.shape[0]
     seqlen = hidden.shape[1]
     dim = hidden.shape[2]
+    # Computed once at trace time so each tile multiplies instead of divides
+    inv_dim = 1.0 / dim
 
     out_tensor = nl.ndarray(hidden.shape, dtype=hidden.dtype, buffer=nl.shared_hbm)
 
@@ -177,39 +600,141 @@ def nki_rmsnorm_kernel(hidden):
     ix = nl.arange(pmax)[:, None]
     iy = nl.arange(dim)[None, :]
 
-    # Process each batch
-    for b in nl.affine_range(batch):
-        # Process pmax (128) rows at a time due to 128-partition tile size limitation
-        # Since we're not reducing across the first dimension
-        # Tiles can be processed independently
-        for i in nl.affine_range(math.ceil(seqlen / pmax)):
+    # Rows are normalized independently, so flatten batch and seqlen into a
+    # single row axis and tile all of them in one loop
+    num_rows = batch * seqlen
+    hidden_rows = hidden.reshape((num_rows, dim))
+    out_rows = out_tensor.reshape((num_rows, dim))
+
+    # Process pmax (128) rows at a time due to 128-partition tile size limitation
+    # Since we're not reducing across the first dimension
+    # Tiles can be processed independently
+    # Only the last tile can be partial, so the full tiles skip the masks
+    for i in nl.affine_range(num_rows // pmax):
+        a_tile = rmsnorm_rows_tile(hidden_rows, i, inv_dim)
+
+        # store the normalized results back to external memory (out_tensor)
+        nl.store(out_rows[i * pmax + ix, iy], value=a_tile)
+
+    if num_rows % pmax != 0:
+        i = num_rows // pmax
+        a_tile = rmsnorm_rows_tile(hidden_rows, i, inv_dim, num_rows=num_rows)
+        nl.store(
+            out_rows[i * pmax + ix, iy],
+            value=a_tile,
+            mask=(i * pmax + ix < num_rows),
+        )
+
+    return out_tensor
 
-            # Load input data from external memory to on-chip memory
-            a_tile = nl.load(
-                hidden[b, i * pmax + ix, iy], mask=(i * pmax + ix < seqlen)
-            )
 
-            # Compute element-wise square of hidden
-            in_square = nl.square(a_tile)
+def rmsnorm_matmul_rows_tile(
+    out_rows, hidden_rows, weights_tiles, i, inv_dim, num_rows=None
+):
+    """Compute rows [i * pmax, (i + 1) * pmax) of RMSNorm(hidden_rows) @ weightT.
+
+    `weights_tiles` holds all of weightT in SBUF as [dim // 128, 128, N]. Pass
+    `num_rows` to mask out the rows past the end of a partial last tile.
+    """
+    pmax = nl.tile_size.pmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
+    NUM_TILES_K = weights_tiles.shape[0]
+    N = weights_tiles.shape[-1]
+
+    a_tile = rmsnorm_rows_tile(hidden_rows, i, inv_dim, num_rows=num_rows)
+
+    # The normalized rows are the stationary matrix of the matmul, transpose them
+    # on the tensor engine so that dim becomes the contraction (partition) axis
+    i_a = nl.mgrid[0:pmax, 0:TILE_K]
+    i_aT = nl.mgrid[0:TILE_K, 0:pmax]
+    aT_tiles = nl.ndarray(
+        (NUM_TILES_K, nl.par_dim(TILE_K), pmax), dtype=a_tile.dtype, buffer=nl.sbuf
+    )
+    for kt in nl.affine_range(NUM_TILES_K):
+        aT_tiles[kt, i_aT.p, i_aT.x] = nl.copy(
+            nisa.nc_transpose(a_tile[i_a.p, kt * TILE_K + i_a.x]), dtype=a_tile.dtype
+        )
+
+    i_rhs = nl.mgrid[0:TILE_K, 0:TILE_N]
+    i_res = nl.mgrid[0:pmax, 0:TILE_N]
+    for n in nl.affine_range(N // TILE_N):
+        res_tile = nl.zeros((pmax, TILE_N), dtype=nl.float32, buffer=nl.psum)
+        for kt in nl.affine_range(NUM_TILES_K):
+            res_tile[...] += nisa.nc_matmul(
+                aT_tiles[kt, i_aT.p, i_aT.x],
+                weights_tiles[kt, i_rhs.p, n * TILE_N + i_rhs.x],
+            )
+        nl.store(
+            out_rows[i * pmax + i_res.p, n * TILE_N + i_res.x],
+            value=nl.copy(res_tile, dtype=out_rows.dtype),
+            mask=(i * pmax + i_res.p < num_rows) if num_rows is not None else None,
+        )
 
-            # Calculate sum of squared elements, along last dimension
-            square_sum = nl.sum(in_square, axis=[1])
 
-            # Scale and get a reciprocal
-            mean = square_sum / dim
+@nki.jit
+def nki_rmsnorm_matmul_(hidden, weightT):
+    """Fused RMSNorm(hidden) @ weightT.
 
-            # Take square root of mean and then reciprocal with
-            # rsqrt API (one ISA instruction)
-            rms_reciprocal = nl.rsqrt(mean)
+    The normalized rows never leave SBUF, they are fed straight into nc_matmul
+    instead of being written to HBM and read back by a separate matmul kernel.
 
-            # Scale the input tensor
-            out_tile = nl.multiply(a_tile, rms_reciprocal)
+    Args:
+        hidden: an input tensor of shape [batch, seqlen, dim], where dim is a
+          multiple of 128.
+        weightT: the projection weights of shape [dim, N], where N is a multiple
+          of 512. The whole tensor is kept resident in SBUF next to the row
+          tiles, so (dim // 128 * N + 2 * dim) elements plus 4 KiB must fit in
+          one 192 KiB SBUF partition.
+        result: the resulting output tensor of shape [batch, seqlen, N]
+    """
+    pmax = nl.tile_size.pmax  # 128
+    TILE_K = nl.tile_size.pmax  # 128
+    TILE_N = nl.tile_size.gemm_moving_fmax  # 512
 
-            # store the addition results back to external memory (out_tensor)
-            nl.store(
-                out_tensor[b, i * pmax + ix, iy],
-                value=out_tile,
-                mask=(i * pmax + ix < seqlen),
-            )
+    batch, seqlen, dim = hidden.shape
+    dim_, N = weightT.shape
+    assert dim == dim_, "hidden and weightT must have the same contraction dimension"
+    assert dim % TILE_K == 0
+    assert N % TILE_N == 0
+    inv_dim = 1.0 / dim
+    NUM_TILES_K = dim // TILE_K
+
+    out_tensor = nl.ndarray(
+        (batch, seqlen, N), dtype=hidden.dtype, buffer=nl.shared_hbm
+    )
+
+    num_rows = batch * seqlen
+    hidden_rows = hidden.reshape((num_rows, dim))
+    out_rows = out_tensor.reshape((num_rows, N))
+
+    # Preload the entire weights tensor, it is reused by every row tile
+    i_w = nl.mgrid[0:TILE_K, 0:N]
+    weights_tiles = nl.ndarray(
+        (NUM_TILES_K, nl.par_dim(TILE_K), N), dtype=weightT.dtype, buffer=nl.sbuf
+    )
+    # Every row tile also holds a_tile and aT_tiles, dim elements per partition
+    # each, plus a margin for the square sums and the output cast of each tile
+    weights_bytes = NUM_TILES_K * N * weights_tiles.itemsize
+    rows_bytes = 2 * dim * np.dtype(hidden.dtype).itemsize + 4 * 1024
+    assert weights_bytes + rows_bytes <= SBUF_BYTES_PER_PARTITION, (
+        f"weightT needs {weights_bytes} bytes per SBUF partition, only "
+        f"{SBUF_BYTES_PER_PARTITION - rows_bytes} are left next to the row tiles"
+    )
+    for kt in nl.affine_range(NUM_TILES_K):
+        weights_tiles[kt, i_w.p, i_w.x] = nl.load(weightT[kt * TILE_K + i_w.p, i_w.x])
+
+    for i in nl.affine_range(num_rows // pmax):
+        rmsnorm_matmul_rows_tile(out_rows, hidden_rows, weights_tiles, i, inv_dim)
+
+    if num_rows % pmax != 0:
+        rmsnorm_matmul_rows_tile(
+            out_rows,
+            hidden_rows,
+            weights_tiles,
+            num_rows // pmax,
+            inv_dim,
+            num_rows=num_rows,
+        )
 
     return out_tensor
@@ -3,24 +3,42 @@
 
 import neuronxcc.nki.language as nl
 import neuronxcc.nki.typing as nt
+import numpy as np
 from itertools import product
+import os
+import pickle
 import random
 
 from src.autotune_kernel import Autotune
-from src.kernels import nki_matmul_fully_optimized_
+from src.allocated_kernels import allocated_matmul
+from src.kernels import (
+    fits_on_chip,
+    nki_matmul,
+    nki_matmul_fully_optimized_,
+    nki_matmul_fully_optimized_nontransposed,
+    nki_matmul_splitk_,
+)
+from neuronxcc.starfish.support.util import allclose
+from neuronxcc.nki import baremetal
 
+TILE_M, TILE_K, TILE_N = 128, 128, 512
 
-def get_autotune_configs():
+
+def get_autotune_configs(M, N, K, dtype_bytes):
     """
     Define a list of configuration dictionaries representing the specific design choices for autotuning.
 
+    Args:
+        M, N, K: matmul shapes, configs that do not evenly block them are skipped.
+        dtype_bytes: size of the input dtype, used by the on-chip capacity model.
+
     Returns:
         list: A list of dictionaries, each containing configuration parameters for TILES_IN_BLOCK_M,
                 TILES_IN_BLOCK_N, and TILES_IN_BLOCK_K.
     """
-    TILES_IN_BLOCK_M_options = [4]
-    TILES_IN_BLOCK_N_options = [2, 4]
-    TILES_IN_BLOCK_K_options = [2, 4]
+    TILES_IN_BLOCK_M_options = [4, 8, 16, 32]
+    TILES_IN_BLOCK_N_options = [1, 2, 4]
+    TILES_IN_BLOCK_K_options = [4, 8, 16]
     params = list(
         product(
             TILES_IN_BLOCK_M_options,
@@ -35,20 +53,144 @@ def get_autotune_configs():
             "TILES_IN_BLOCK_N": TILES_IN_BLOCK_N,
             "TILES_IN_BLOCK_K": TILES_IN_BLOCK_K,
         }
+        if M % (TILE_M * TILES_IN_BLOCK_M) != 0:
+            continue
+        if N % (TILE_N * TILES_IN_BLOCK_N) != 0:
+            continue
+        if K % (TILE_K * TILES_IN_BLOCK_K) != 0:
+            continue
+        if not fits_on_chip(config, dtype_bytes):
+            continue
         configs.append(config)
     random.shuffle(configs)
     return configs
 
 
+def save_best_config(cache_file, key, config):
+    """Record `config` as the best one for `key` in the pickled dict `cache_file`."""
+    best_configs = {}
+    if os.path.exists(cache_file):
+        best_configs = pickle.load(open(cache_file, "rb"))
+    best_configs[key] = config
+    pickle.dump(best_configs, open(cache_file, "wb"))
+
+
+def verify(dtype, K):
+    """
+    Check the matmul kernels against an fp32 np.matmul of the same device inputs.
+
+    K is blocked by 512, so K=1536 gives an odd number of K blocks and K=512 a
+    single one, which skips the pipelined K loop entirely.
+    The fully optimized kernels keep their partial sums across K blocks in bf16, so
+    every one of the NUM_BLOCK_K SBUF accumulations rounds to 8 mantissa bits
+    (relative error up to 2**-8 each), which rtol=2e-2 covers for up to 3 K blocks.
+    The split-K partial sums stay in fp32, so only the final cast to the output
+    dtype rounds.
+    """
+    M, N = 512, 1024
+    blocking = {"TILES_IN_BLOCK_M": 2, "TILES_IN_BLOCK_N": 1, "TILES_IN_BLOCK_K": 4}
+    atol = 1e-2
+    bf16_rtol = 2e-2
+    out_rtol = 1e-2 if dtype == nl.bfloat16 else 1e-3
+
+    lhsT = np.random.random_sample((K, M))
+    rhs = np.random.random_sample((K, N))
+    lhsT_dev = nl.static_cast(lhsT, dtype)
+    rhs_dev = nl.static_cast(rhs, dtype)
+    golden_res = np.matmul(
+        nl.static_cast(lhsT_dev, np.float32).T, nl.static_cast(rhs_dev, np.float32)
+    )
+
+    checks = [
+        (
+            "nki_matmul_fully_optimized_",
+            nki_matmul_fully_optimized_,
+            (lhsT_dev, rhs_dev),
+            blocking,
+            bf16_rtol,
+        ),
+        (
+            "nki_matmul_fully_optimized_nontransposed",
+            nki_matmul_fully_optimized_nontransposed,
+            (np.ascontiguousarray(lhsT_dev.T), rhs_dev),
+            blocking,
+            bf16_rtol,
+        ),
+    ]
+    if K % (TILE_K * 2 * 3) == 0:
+        # 3 splits of 2-tile K blocks
+        checks.append(
+            (
+                "nki_matmul_splitk_",
+                nki_matmul_splitk_,
+                (lhsT_dev, rhs_dev),
+                {**blocking, "SPLIT_K": 3, "TILES_IN_BLOCK_K": 2},
+                out_rtol,
+            )
+        )
+    if dtype == nl.bfloat16:
+        # allocated_matmul only handles fp16/bf16 inputs
+        checks.append(
+            (
+                "allocated_matmul",
+                allocated_matmul,
+                (lhsT_dev, rhs_dev),
+                blocking,
+                bf16_rtol,
+            )
+        )
+
+    for name, kernel, args, kwargs, rtol in checks:
+        numeric_func = baremetal(kernel)
+        nki_out = nl.static_cast(numeric_func(*args, **kwargs), np.float32)
+        match = allclose(nki_out, golden_res, atol=atol, rtol=rtol, verbose=1)
+        assert match, f"{name} match for {dtype}: {match}"
+
+
+def verify_nki_matmul(dtype):
+    """Check both paths of the nki_matmul dispatcher against lhsT.T @ rhs."""
+    atol = 1e-2
+    shapes = [
+        # Fully optimized kernel, M only fits TILES_IN_BLOCK_M=2
+        (256, 1024, 4096, 2e-2),
+        # Fully optimized kernel at the default blocking, which the dispatcher has
+        # to shrink for fp32
+        (2048, 1024, 2048, 2e-2),
+        # Split-K kernel, N only fits TILES_IN_BLOCK_N=1
+        (256, 512, 16384, 1e-2 if dtype == nl.bfloat16 else 1e-3),
+    ]
+    for M, N, K, rtol in shapes:
+        lhsT_dev = nl.static_cast(np.random.random_sample((K, M)), dtype)
+        rhs_dev = nl.static_cast(np.random.random_sample((K, N)), dtype)
+        golden_res = np.matmul(
+            nl.static_cast(lhsT_dev, np.float32).T,
+            nl.static_cast(rhs_dev, np.float32),
+        )
+        nki_out = nl.static_cast(nki_matmul(lhsT_dev, rhs_dev), np.float32)
+        match = allclose(nki_out, golden_res, atol=atol, rtol=rtol, verbose=1)
+        assert match, f"nki_matmul match for {(M, N, K, dtype)}: {match}"
+
+
 if __name__ == "__main__":
-    lhsT = nt.tensor[[8192, 4096], nl.bfloat16]
-    rhs = nt.tensor[[8192, 8192], nl.bfloat16]
+    for dtype in [nl.bfloat16, np.float32]:
+        verify(dtype, K=1536)
+        verify(dtype, K=512)
+        verify_nki_matmul(dtype)
+
+    M, N, K = 4096, 8192, 8192
+    lhsT = nt.tensor[[K, M], nl.bfloat16]
+    rhs = nt.tensor[[K, N], nl.bfloat16]
 
     tuner = Autotune(
         nki_matmul_fully_optimized_,
-        configs=get_autotune_configs(),
+        configs=get_autotune_configs(M, N, K, dtype_bytes=2),
         warmup=2,
         iters=10,
         max_workers=2,
     )
     tuner(lhsT, rhs)
+    # tuner.cache_dir is wiped on every tuning run, keep the best configs of all
+    # shapes one level up
+    cache_file = f"{os.path.dirname(tuner.cache_dir)}/best_configs.pkl"
+    save_best_config(cache_file, (M, N, K, "bfloat16"), tuner.best_config)
+    print(f"Best config for {(M, N, K, 'bfloat16')}: {tuner.best_config}")
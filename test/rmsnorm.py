@@ -8,7 +8,7 @@ import numpy as np
 from src.autotune_kernel import Autotune
 from src.benchmark import test_kernel
 from src.allocated_kernels import allocated_fused_rms_norm_qkv, allocated_rms_norm
-from src.kernels import nki_rmsnorm_kernel
+from src.kernels import nki_rmsnorm_kernel, nki_rmsnorm_matmul_
 from neuronxcc.starfish.support.util import allclose
 from neuronxcc.nki import baremetal
 
@@ -73,12 +73,24 @@ def verify(batch, seqlen, dim, d_head, hidden_buffer_degree):
     match = allclose(nki_out, golden_res, atol=atol, rtol=rtol, verbose=1)
     assert match, f"nki_rmsnorm_kernel match: {match} {golden_res.shape}"
 
+    golden_res = nl.static_cast(
+        cpu_golden_result(hidden, dtype, qkv_weights=qkv_weights), np.float32
+    )
+    numeric_func = baremetal(nki_rmsnorm_matmul_)
+    nki_out = numeric_func(hidden_dev, qkv_weights_dev)
+    nki_out = nl.static_cast(nki_out, np.float32)
+    match = allclose(nki_out, golden_res, atol=atol, rtol=rtol, verbose=1)
+    assert match, f"nki_rmsnorm_matmul_ match: {match} {golden_res.shape}"
+
 
 if __name__ == "__main__":
     batch, seqlen, dim, d_head = 1, 2048, 4096, 512
     configs = get_autotune_configs()
     for config in configs:
         verify(batch, seqlen, dim, d_head, config["hidden_buffer_degree"])
+        # A seqlen that is not a multiple of 128 over several batches exercises the
+        # masked tail tile and the tiles that straddle batch boundaries
+        verify(3, 100, dim, d_head, config["hidden_buffer_degree"])
     hidden = nt.tensor[[batch, seqlen, dim], nl.bfloat16]
     weights = nt.tensor[[dim, d_head], nl.bfloat16]
 